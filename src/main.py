@@ -1,55 +1,118 @@
 from __future__ import annotations
 
+import asyncio
+import hmac
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from typing import TYPE_CHECKING
 
 import aiohttp
+import orjson
 from aiohttp import web
 
 if TYPE_CHECKING:
   from typing import Union
 
+LOG = logging.getLogger(__name__)
+
+# Frame types that carry a relayable payload; built once rather than per message.
+_DATA_TYPES = (aiohttp.WSMsgType.TEXT,aiohttp.WSMsgType.BINARY)
+
 channels: dict[str,Channel] = {}
 
 class Channel:
   name: str
   passwd: str
-  clients: list[web.WebSocketResponse]
+  clients: set[web.WebSocketResponse]
 
   def __init__(self, name: str, passwd: str) -> None:
     self.name = name
     self.passwd = passwd
-    self.clients = []
+    self.clients = set()
+
+  async def _client_writer(self,ws:web.WebSocketResponse) -> None:
+    # Drains one client's queue so a broadcast never waits on its socket.
+    # The loop runs once per delivered message, so bind everything it
+    # touches to locals up front; attribute loads cost several times a
+    # local load in CPython.
+    outq = ws._outq
+    get = outq.get
+    empty = outq.empty
+    get_nowait = outq.get_nowait
+    send_str = ws.send_str
+    send_bytes = ws.send_bytes
+    batch_mode = ws._batch
+    while True:
+      binary, msg = await get()
+      try:
+        if binary:
+          await send_bytes(msg)
+        elif batch_mode:
+          # Coalesce whatever else is queued (up to 64 KiB) into one JSON
+          # array frame so bursts of small messages share the framing cost.
+          batch = [msg]
+          size = len(msg)
+          extra = None
+          while size < 65536 and not empty():
+            nxt_binary, nxt = get_nowait()
+            if nxt_binary:
+              extra = nxt # Binary frame; send it after the batch.
+              break
+            batch.append(nxt)
+            size += len(nxt)
+          await send_str(orjson.dumps(batch).decode())
+          if extra is not None:
+            await send_bytes(extra)
+        else:
+          await send_str(msg)
+      except ConnectionResetError:
+        break # Connection died mid-send; the handler loop cleans up.
 
   async def send_message(self,msg:Union[str,bytes],sender:web.WebSocketResponse) -> None:
-    for ws in self.clients:
+    # Decide str vs bytes once per broadcast rather than once per client.
+    item = (type(msg) is bytes,msg)
+    # Snapshot so a client joining/leaving mid-broadcast can't break iteration.
+    for ws in tuple(self.clients):
       if ws != sender:
-        if type(msg) is str:
-          await ws.send_str(msg)
-        else:
-          await ws.send_bytes(msg)
+        try:
+          ws._outq.put_nowait(item)
+        except asyncio.QueueFull:
+          # Client can't keep up; drop it rather than stall the channel.
+          if not hasattr(ws,"_close_task"):
+            LOG.warning("[CHAN %s] client too slow, disconnecting.",self.name)
+            ws._close_task = asyncio.create_task(ws.close())
 
   async def handle_websocket(self,request: web.Request) -> web.Response:
     ws = web.WebSocketResponse(heartbeat=10.0)
     await ws.prepare(request)
 
-    self.clients.append(ws)
-    print(f"[CHAN {self.name}] new client. {len(self.clients)} connected.")
+    # aiohttp's default 16 KiB write buffer forces a drain between small
+    # messages; give bursts room to sit in the buffer instead. Costs memory
+    # per slow client, but the bounded queue drops those anyway.
+    ws._writer._limit = 2 ** 20
+
+    # Clients connecting with ?batch=1 get queued text messages coalesced
+    # into JSON array frames instead of one frame per message.
+    ws._batch = request.query.get("batch") == "1"
+    ws._outq = asyncio.Queue(maxsize=256)
+    ws._writer_task = asyncio.create_task(self._client_writer(ws))
+    self.clients.add(ws)
+    LOG.info("[CHAN %s] new client. %s connected.",self.name,len(self.clients))
 
     async for msg in ws:
-      if msg.type in (aiohttp.WSMsgType.TEXT,aiohttp.WSMsgType.BINARY):
+      if msg.type in _DATA_TYPES:
         await self.send_message(msg.data,ws)
       else:
-        print(f"{self.name}: ws connection closed with exception {ws.exception()}")
-    try:
-      self.clients.remove(ws)
-    except: pass
-    print(f"[CHAN {self.name}]: client disconnected. {len(self.clients)} connected.")
+        LOG.warning("%s: ws connection closed with exception %s",self.name,ws.exception())
+    ws._writer_task.cancel()
+    self.clients.discard(ws)
+    LOG.info("[CHAN %s]: client disconnected. %s connected.",self.name,len(self.clients))
     # Check if we're empty
     if not self.clients:
       channels.pop(self.name)
-      print(f"[CHAN {self.name}]: empty, removing.\nChannels:")
-      for channel in channels.values():
-        print(f" - {channel}")
+      LOG.info("[CHAN %s]: empty, removing. Channels:\n%s",self.name,
+               "\n".join(f" - {channel}" for channel in channels.values()))
 
     return ws
   
@@ -66,9 +129,9 @@ async def websocket_handler(request: web.Request) -> web.Response:
   except ValueError:
     channel = conndetails
     password = ""
-  if channel in channels: # We are connecting to an existing channel.
-    c = channels[channel]
-    if password == c.passwd:
+  c = channels.get(channel)
+  if c is not None: # We are connecting to an existing channel.
+    if hmac.compare_digest(password.encode(),c.passwd.encode()):
       return await c.handle_websocket(request)
     else:
       return web.Response(status=403)
@@ -82,4 +145,17 @@ app = web.Application()
 
 app.add_routes(routes)
 
+# logging writes synchronously under a lock, which would block the event
+# loop; queue records to a background thread and let it own the stream.
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+QueueListener(_log_queue,_stream_handler).start()
+# Not basicConfig: it would stick a formatter on the QueueHandler too and
+# every record would be formatted twice.
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger().addHandler(QueueHandler(_log_queue))
 web.run_app(app,port=11999)
\ No newline at end of file